@@ -0,0 +1,95 @@
+"""
+Database micro-benchmark: commit and lookup latency with default and tuned engine
+
+python benchmarks/db_benchmark.py [users] [operations]
+"""
+import asyncio
+import importlib.util
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, List
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+# vk_bot/__init__.py starts the bot, so db module is loaded by path
+_spec = importlib.util.spec_from_file_location(
+    "db", Path(__file__).parent.parent / "vk_bot" / "db.py"
+)
+db = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(db)  # type: ignore
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+OPERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+CONCURRENCY = 16  # like scheduler jobs and updates at the same time
+
+
+async def _measure(operation: Callable[[int], Awaitable], count: int) -> List[float]:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies: List[float] = []
+
+    async def timed(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await operation(i)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*map(timed, range(count)))
+    return latencies
+
+
+def _report(name: str, latencies: List[float]):
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"  {name:<8} mean {statistics.mean(latencies):7.2f} ms"
+        f"  p50 {statistics.median(latencies):7.2f} ms  p95 {p95:7.2f} ms"
+    )
+
+
+async def run(tuned: bool):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = db.make_engine(f"sqlite+aiosqlite:///{directory}/db.sqlite3", tuned=tuned)
+        factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(db.Base.metadata.create_all)
+        async with factory() as session:
+            session.add_all(
+                db.User(
+                    vk_id=vk_id,
+                    diary_session="session",
+                    diary_information={},
+                    children=[db.Child(vk_id=vk_id, child_id=0)],
+                    chats=[],
+                )
+                for vk_id in range(USERS)
+            )
+            await session.commit()
+
+        async def commit(i: int):  # settings click: Child.save()
+            async with factory() as session:
+                child = await session.get(db.Child, (i % USERS, 0))
+                child.marks_notify = not child.marks_notify
+                await session.commit()
+
+        async def lookup(i: int):  # User.get() and Child.marks_count() of an update
+            async with factory() as session:
+                await session.get(db.User, i * 7 % USERS)
+                (await session.execute(db._MARKS_COUNT)).scalar_one()
+
+        print(f"{'tuned' if tuned else 'default'} ({USERS} users, {OPERATIONS} operations)")
+        _report("commit", await _measure(commit, OPERATIONS))
+        _report("lookup", await _measure(lookup, OPERATIONS))
+        await engine.dispose()
+
+
+async def main():
+    await run(tuned=False)
+    await run(tuned=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""
+NotificationQueue against fake VK API (python -m pytest tests)
+"""
+import asyncio
+import importlib.util
+import json
+import re
+from pathlib import Path
+from typing import List, Optional
+
+from vkbottle import VKAPIError
+
+# vk_bot/__init__.py starts the bot, so notifications module is loaded by path
+_spec = importlib.util.spec_from_file_location(
+    "notifications", Path(__file__).parent.parent / "vk_bot" / "notifications.py"
+)
+notifications = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(notifications)  # type: ignore
+
+
+class FakeAPI:
+    """execute method: messages.send calls from code, `failed` peer_ids are not sent"""
+
+    def __init__(self, failed: Optional[List[str]] = None, flood: int = 0):
+        self.failed = failed or []
+        self.flood = flood  # count of rejected execute requests
+        self.requests = 0
+        self.sent: List[str] = []
+
+    async def request(self, method: str, data: dict) -> dict:
+        assert method == "execute"
+        self.requests += 1
+        if self.flood:
+            self.flood -= 1
+            raise VKAPIError[9](error_msg="Flood control", request_params=[])
+        calls = re.findall(r"API\.messages\.send\((.*?)\)}", data["code"])
+        response = []
+        for call in map(json.loads, calls):
+            sent = call["peer_ids"] not in self.failed
+            if sent:
+                self.sent.append(call["message"])
+            response.append({"sent": sent})
+        return {"response": response}
+
+
+def _flush(queue, api: FakeAPI) -> int:
+    notifications.RATE = 1000  # without delays between requests
+    return asyncio.run(queue.flush(api))
+
+
+def test_batches():
+    queue = notifications.NotificationQueue()
+    for i in range(notifications.BATCH_SIZE + 1):
+        queue.put([i], f"message {i}")
+    api = FakeAPI()
+
+    assert _flush(queue, api) == notifications.BATCH_SIZE + 1
+    assert api.requests == 2
+    assert len(queue) == 0
+
+
+def test_partial_failure_is_sent_again():
+    queue = notifications.NotificationQueue()
+    queue.put([1, 2], "first")
+    queue.put([3], "second")
+    api = FakeAPI(failed=["3"])
+
+    assert _flush(queue, api) == 1
+    assert len(queue) == 1
+
+    api.failed = []
+    assert _flush(queue, api) == 1
+    assert api.sent == ["first", "second"]
+    assert len(queue) == 0
+
+
+def test_flood_error_requeues_batch():
+    queue = notifications.NotificationQueue()
+    for i in range(notifications.BATCH_SIZE * 2):
+        queue.put([i], f"message {i}")
+    api = FakeAPI(flood=1)
+
+    assert _flush(queue, api) == 0
+    assert api.requests == 1  # next batches wait for the next flush
+    assert len(queue) == notifications.BATCH_SIZE * 2
+
+    assert _flush(queue, api) == notifications.BATCH_SIZE * 2
+    assert len(queue) == 0
+
+
+def test_dropped_after_attempts():
+    queue = notifications.NotificationQueue()
+    queue.put([1], "message")
+    api = FakeAPI(failed=["1"])
+
+    for _ in range(notifications.ATTEMPTS):
+        assert len(queue) == 1
+        assert _flush(queue, api) == 0
+    assert len(queue) == 0
+    assert api.requests == notifications.ATTEMPTS
@@ -1,12 +1,13 @@
 """
 Admin features and commands
 """
-from barsdiary.aio import DiaryApi
 from vkbottle.bot import Blueprint, BotLabeler, Message, rules
 
-from vk_bot.db import Chat, Child, User
+from vk_bot.db import User, stats
 from vk_bot.error_handler import message_error_handler
+from vk_bot.sessions import sessions
 
+from . import scheduler
 from .other import ADMINS
 
 IsAdmin = rules.FromPeerRule(ADMINS)
@@ -29,15 +30,17 @@ async def admin_delete_command(message: Message, vk_id: int):
     state_peer = await bp.state_dispenser.get(vk_id)
     if state_peer:
         try:
+            api = await sessions.get(vk_id)  # before user is deleted from db
             user = await User.get(vk_id)
+            for child in user.children:
+                await scheduler.delete(child)
             await user.delete()
         finally:
             pass
 
         try:
-            api: DiaryApi = state_peer.payload["api"]
             await api.logout()
-            await api.close_session()
+            await sessions.close(vk_id)
         finally:
             pass
 
@@ -53,9 +56,12 @@ async def admin_delete_command(message: Message, vk_id: int):
 @message_error_handler.catch
 async def admin_marks_command(message: Message):
     await message.answer(
-        f"🔸 Пользователи: {await User.count()}\n"
-        f"🔸 Беседы: {await Chat.count()}\n"
-        f"🔸 Уведомления: {await Child.marks_count()}"
+        f"🔸 Пользователи: {stats.users}\n"
+        f"🔸 Беседы: {stats.chats}\n"
+        f"🔸 Уведомления: {stats.subscribed}\n"
+        f"🔸 Сессии дневника: {len(sessions)}\n"
+        f"🔸 Сервер дневника: {scheduler.diary_breaker.state} "
+        f"(ошибок подряд: {scheduler.diary_breaker.failures})"
     )
 
 
@@ -63,7 +69,7 @@ async def admin_marks_command(message: Message):
 async def admin_post(message: Message, text: str):
     bad_count = 0
     good_count = 0
-    for user in await User.get_all():
+    async for user in User.iter_all(User.vk_id):  # only vk_id is loaded
         try:
             await bp.api.messages.send(
                 peer_id=user.vk_id, random_id=0, message=f"🔔 Уведомление\n\n{text}"
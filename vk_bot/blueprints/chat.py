@@ -3,16 +3,17 @@ Chat integration (all chat message handler)
 """
 from typing import Tuple
 
-from barsdiary.aio import DiaryApi
+from barsdiary.types import DiaryObject
 from loguru import logger
 from vkbottle.bot import Blueprint, BotLabeler, Message, rules
 from vkbottle.dispatch.dispenser import get_state_repr
 from vkbottle_types.objects import MessagesMessageActionStatus
 
-from vk_bot import keyboard
+from vk_bot import diary_cache, keyboard
 from vk_bot.db import Chat
-from vk_bot.diary_infromation import diary_info
+from vk_bot.diary_infromation import diary_info, freshness_info
 from vk_bot.error_handler import diary_date_error_handler, message_error_handler
+from vk_bot.sessions import get_api
 
 from .other import MeowState, admin_log, tomorrow
 
@@ -102,7 +103,6 @@ async def start_command(message: Message):
             await bp.state_dispenser.set(
                 message.peer_id,
                 MeowState.AUTH,
-                api=user_state_peer.payload["api"],
                 user_id=message.from_id,
                 child_id=0,
             )
@@ -124,22 +124,34 @@ async def start_command(message: Message):
         )
 
 
-# todo flood control
 @bp.on.message(
     rules.CommandRule(("дневник", 1)) | rules.CommandRule(("diary", 1)), state=MeowState.AUTH
 )
 @diary_date_error_handler.catch
 async def diary_command(message: Message, args: Tuple[str]):
     date = args[0]
-    api: DiaryApi = message.state_peer.payload["api"]
+    api = await get_api(message.state_peer)
     child_id: int = message.state_peer.payload["child_id"]
-    diary = await api.diary(date, child=child_id)
-    await message.answer(
-        message=diary_info(diary, is_chat=True),
+    served = await diary_cache.serve_diary(api, date, child_id)
+    response = await message.answer(
+        message=diary_info(served.data, is_chat=True) + freshness_info(served.age),
         keyboard=keyboard.diary_week(date),
         dont_parse_links=True,
     )
 
+    async def edit(diary: DiaryObject):
+        await bp.api.messages.edit(
+            peer_id=response.peer_id,
+            conversation_message_id=response.conversation_message_id,
+            message=diary_info(diary, is_chat=True),
+            keyboard=keyboard.diary_week(date),
+            dont_parse_links=True,
+        )
+
+    diary_cache.show_day(response.peer_id, response.conversation_message_id, date, served)
+    diary_cache.on_refresh(served, edit)
+    diary_cache.prefetch(api, date, child_id)
+
 
 @bp.on.message(rules.CommandRule("дневник") | rules.CommandRule("diary"), state=MeowState.AUTH)
 @diary_date_error_handler.catch
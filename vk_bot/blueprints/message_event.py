@@ -4,19 +4,22 @@ MessageEvent integration (all message_event handler, chat and private)
 from typing import List, Union
 
 from barsdiary.aio import DiaryApi
+from barsdiary.types import DiaryObject
 from vkbottle import ABCRule, BaseStateGroup, GroupEventType
 from vkbottle.bot import Blueprint, MessageEvent
 from vkbottle.dispatch.dispenser import get_state_repr
 
-from vk_bot import keyboard
+from vk_bot import diary_cache, keyboard
 from vk_bot.db import Child, User
 from vk_bot.diary_infromation import (
     diary_info,
     diary_lesson_info,
+    freshness_info,
     lesson_score_info,
     progress_average_info,
 )
 from vk_bot.error_handler import callback_error_handler
+from vk_bot.sessions import get_api, sessions
 
 from . import scheduler
 from .other import MeowState, admin_log
@@ -58,22 +61,31 @@ async def not_auth_handler(event: MessageEvent):
 @callback_error_handler.catch
 async def diary_day_handler(event: MessageEvent):
     state_peer = await bp.state_dispenser.get(event.peer_id)
-    api: DiaryApi = state_peer.payload["api"]
+    api = await get_api(state_peer)
     payload = event.payload
     date: str = payload["date"]
     child: int = state_peer.payload["child_id"]
     lesson_index: int = payload["lesson"]
-    diary = await api.diary(date, child=child)
-    if diary.days[0].lessons is not None and len(diary.days[0].lessons) > 0:
-        lesson = diary.days[0].lessons[lesson_index]
-        await event.edit_message(
-            message=diary_lesson_info(lesson, event.peer_id != event.user_id, True),
-            keyboard=keyboard.diary_day(date, diary.days[0].lessons, lesson_index),
-        )
-    else:
-        await event.edit_message(
-            message=diary.days[0].kind, keyboard=keyboard.diary_day(date, [], lesson_index)
-        )
+    served = await diary_cache.message_diary(
+        api, event.peer_id, event.conversation_message_id, date, child
+    )
+
+    async def edit(diary: DiaryObject, age: float = 0.0):
+        if diary.days[0].lessons is not None and len(diary.days[0].lessons) > 0:
+            lesson = diary.days[0].lessons[lesson_index]
+            await event.edit_message(
+                message=diary_lesson_info(lesson, event.peer_id != event.user_id, True)
+                + freshness_info(age),
+                keyboard=keyboard.diary_day(date, diary.days[0].lessons, lesson_index),
+            )
+        else:
+            await event.edit_message(
+                message=diary.days[0].kind + freshness_info(age),
+                keyboard=keyboard.diary_day(date, [], lesson_index),
+            )
+
+    await edit(served.data, served.age)
+    diary_cache.on_refresh(served, edit)
 
 
 @bp.on.raw_event(
@@ -86,15 +98,27 @@ async def diary_day_handler(event: MessageEvent):
 @callback_error_handler.catch
 async def diary_week_handler(event: MessageEvent):
     state_peer = await bp.state_dispenser.get(event.peer_id)
-    api: DiaryApi = state_peer.payload["api"]
+    api = await get_api(state_peer)
     payload = event.payload
     date: str = payload["date"]
     child: int = state_peer.payload["child_id"]
-    diary = await api.diary(date, child=child)
-    await event.edit_message(
-        message=diary_info(diary, event.peer_id != event.user_id),
-        keyboard=keyboard.diary_week(date),
-    )
+    if payload.get("hide"):  # day of lesson view
+        served = await diary_cache.message_diary(
+            api, event.peer_id, event.conversation_message_id, date, child
+        )
+    else:
+        served = await diary_cache.serve_diary(api, date, child)
+        diary_cache.show_day(event.peer_id, event.conversation_message_id, date, served)
+
+    async def edit(diary: DiaryObject, age: float = 0.0):
+        await event.edit_message(
+            message=diary_info(diary, event.peer_id != event.user_id) + freshness_info(age),
+            keyboard=keyboard.diary_week(date),
+        )
+
+    await edit(served.data, served.age)
+    diary_cache.on_refresh(served, edit)
+    diary_cache.prefetch(api, date, child)
 
 
 @bp.on.raw_event(
@@ -107,27 +131,31 @@ async def diary_week_handler(event: MessageEvent):
 @callback_error_handler.catch
 async def marks_handler(event: MessageEvent):
     state_peer = await bp.state_dispenser.get(event.peer_id)
-    api: DiaryApi = state_peer.payload["api"]
+    api = await get_api(state_peer)
     payload = event.payload
     date: str = payload["date"]
     count: bool = payload["count"]
     child: int = state_peer.payload["child_id"]
-    if count:
-        marks = await api.lessons_scores(date, child=child)
-        text = lesson_score_info(marks)
-    else:
-        marks = await api.progress_average(date, child=child)
-        text = progress_average_info(marks)
-    await event.edit_message(message=text, keyboard=keyboard.marks_stats(date, count))
+    kind = "lessons_scores" if count else "progress_average"
+    served = await diary_cache.last_scores(api, kind, date, child)
+
+    async def edit(data, age: float = 0.0):
+        text = lesson_score_info(data) if count else progress_average_info(data)
+        await event.edit_message(
+            message=text + freshness_info(age), keyboard=keyboard.marks_stats(date, count)
+        )
+
+    await edit(served.data, served.age)
+    diary_cache.on_refresh(served, edit)
 
 
-async def change_child_marks(child: Child) -> str:
+async def change_child_marks(child: Child, api: DiaryApi) -> str:
     if child.marks_notify:
         await scheduler.delete(child)
         child.marks_notify = False
         text = "🔔 Уведомления об оценках выключены"
     else:
-        await scheduler.add(child)
+        await scheduler.add(child, api)
         child.marks_notify = True
         text = "🔔 Уведомления об оценках включены"
     await child.save()
@@ -143,12 +171,12 @@ async def change_child_marks(child: Child) -> str:
 @callback_error_handler.catch
 async def settings_marks_child_handler(event: MessageEvent):
     state_peer = await bp.state_dispenser.get(event.peer_id)
-    api: DiaryApi = state_peer.payload["api"]
+    api = await get_api(state_peer)
     user = await User.get(event.peer_id)
 
     child_id = event.payload.get("child_id")
     if type(child_id) == int:
-        await event.show_snackbar(await change_child_marks(user.children[child_id]))
+        await event.show_snackbar(await change_child_marks(user.children[child_id], api))
     await event.edit_message(
         message="⚙ Настройки уведомлений об оценках",
         keyboard=keyboard.settings_marks(user, api.user.children),
@@ -166,9 +194,11 @@ async def settings_marks_child_handler(event: MessageEvent):
 async def settings_marks_handler(event: MessageEvent):
     child_id = event.payload["child_id"]
 
+    state_peer = await bp.state_dispenser.get(event.peer_id)
+    api = await get_api(state_peer)
     user = await User.get(event.peer_id)
 
-    await event.show_snackbar(await change_child_marks(user.children[child_id]))
+    await event.show_snackbar(await change_child_marks(user.children[child_id], api))
     await event.edit_message(message="⚙ Настройки", keyboard=keyboard.settings(user))
 
 
@@ -184,7 +214,7 @@ async def settings_child_select_handler(event: MessageEvent):
     child_id = event.payload["child_id"]
 
     state_peer = await bp.state_dispenser.get(event.peer_id)
-    api: DiaryApi = state_peer.payload["api"]
+    api = await get_api(state_peer)
 
     state_peer.payload["child_id"] = child_id
 
@@ -203,7 +233,7 @@ async def settings_child_select_handler(event: MessageEvent):
 @callback_error_handler.catch
 async def settings_child_handler(event: MessageEvent):
     state_peer = await bp.state_dispenser.get(event.peer_id)
-    api: DiaryApi = state_peer.payload["api"]
+    api = await get_api(state_peer)
 
     await event.edit_message(
         message="⚙ Выбор ученика",
@@ -231,7 +261,6 @@ async def user_delete_handler(event: MessageEvent):
 )
 @callback_error_handler.catch
 async def delete_verify_handler(event: MessageEvent):
-    state_peer = await bp.state_dispenser.get(event.peer_id)
     user = await User.get(event.peer_id)
     for chat in user.chats:
         await bp.api.messages.send(
@@ -241,11 +270,13 @@ async def delete_verify_handler(event: MessageEvent):
             "🔒 Напишите /начать (/start), что бы авторизовать беседу заново.",
         )
         await bp.state_dispenser.delete(chat.peer_id)
+    api = await sessions.get(event.peer_id)  # before user is deleted from db
+    for child in user.children:
+        await scheduler.delete(child)
     await user.delete()
 
-    api: DiaryApi = state_peer.payload["api"]
     await api.logout()
-    await api.close_session()
+    await sessions.close(event.peer_id)
 
     await bp.state_dispenser.delete(event.peer_id)
 
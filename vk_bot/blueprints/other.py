@@ -1,17 +1,21 @@
 """
 Additional functions with blueprint integration (bp.state_dispenser and bp.api)
 """
+import asyncio
 import datetime
-import json
-from asyncio import TimeoutError
+from typing import Dict, Optional
 
-from barsdiary.aio import APIError, DiaryApi
-from vkbottle import BaseStateGroup
-from vkbottle.bot import Blueprint
+from barsdiary.aio import APIError
+from vkbottle import BaseMiddleware, BaseStateGroup, GroupEventType
+from vkbottle.bot import Blueprint, Message, MessageEvent
+from vkbottle.dispatch.dispenser import StatePeer, get_state_repr
+from vkbottle.dispatch.rules.base import DEFAULT_PREFIXES
 from vkbottle.modules import logger
 
-from vk_bot import keyboard
-from vk_bot.db import User
+from vk_bot import diary_cache, keyboard
+from vk_bot.db import Chat, User, stats
+from vk_bot.flood_control import flood_control, flood_info
+from vk_bot.sessions import get_api, sessions
 
 ADMINS = [
     248525108,  # @mironovmeow      | Миронов Данил
@@ -57,6 +61,7 @@ async def re_auth(error: APIError, peer_id: int):
         )
     else:
         await error.session.close()
+        await sessions.close(peer_id)
 
         await admin_log(f"Произошёл re-auth @id{peer_id}")
         await bp.state_dispenser.set(peer_id, MeowState.RE_LOGIN)
@@ -70,33 +75,140 @@ async def re_auth(error: APIError, peer_id: int):
         )
 
 
+_loading = True  # startup authorization is not finished
+# vk_id: task of authorization on demand (None, if user is authorized by startup)
+_auth_tasks: Dict[int, Optional["asyncio.Task[bool]"]] = {}
+
+
+async def _auth_user(user: User) -> bool:
+    # DiaryApi is created by sessions on the first request
+    await bp.state_dispenser.set(user.vk_id, MeowState.AUTH, child_id=0)
+    logger.debug(f"Auth id{user.vk_id} complete")
+
+    for chat in user.chats:
+        await bp.state_dispenser.set(chat.peer_id, MeowState.AUTH, user_id=user.vk_id, child_id=0)
+        logger.debug(f"Auth chat{chat.peer_id - 2_000_000_000} complete")
+    return True
+
+
+async def _auth_vk_id(vk_id: int) -> bool:
+    user = await User.get(vk_id)
+    return user is not None and await _auth_user(user)
+
+
+async def restore(peer_id: int):
+    """Authorize user (or user of chat) now, if it isn't authorized by startup yet"""
+    if not _loading:
+        return
+    if peer_id > 2_000_000_000:  # is chat
+        chat = await Chat.get(peer_id)
+        if chat is None:
+            return
+        peer_id = chat.vk_id
+
+    if peer_id not in _auth_tasks:  # first call
+        _auth_tasks[peer_id] = asyncio.create_task(_auth_vk_id(peer_id))
+    task = _auth_tasks[peer_id]
+    if task is not None:
+        await task
+
+
 async def auth_users_and_chats():
+    """Users are loaded from db by batches, so the bot works while they are authorized"""
+    global _loading
     logger.debug("Start auth from db")
-    count_user, count_chat = 0, 0
-    for user in await User.get_all():
-        try:
-            api = await DiaryApi.auth_by_diary_session(
-                "sosh.mon-ra.ru",  # TODO add region select
-                user.diary_session,
-                json.loads(user.diary_information),
-            )
-            await bp.state_dispenser.set(user.vk_id, MeowState.AUTH, api=api, child_id=0)
-            logger.debug(f"Auth id{user.vk_id} complete")
-            count_user += 1
-
-            for chat in user.chats:
-                await bp.state_dispenser.set(
-                    chat.peer_id, MeowState.AUTH, api=api, user_id=user.vk_id, child_id=0
-                )
-                logger.debug(f"Auth chat{chat.peer_id - 2_000_000_000} complete")
-                count_chat += 1
-        except (APIError, TimeoutError):
-            await bp.state_dispenser.set(user.vk_id, MeowState.NOT_AUTH, user=user)
-            logger.debug(f"Auth id{user.vk_id} not complete")
-
-            for chat in user.chats:
-                await bp.state_dispenser.set(chat.peer_id, MeowState.NOT_AUTH, user_id=user.vk_id)
-                logger.debug(f"Auth chat{chat.peer_id - 2_000_000_000} not complete")
 
+    async for user in User.iter_all():
+        if user.vk_id not in _auth_tasks:  # else it's authorized on demand
+            _auth_tasks[user.vk_id] = None
+            await _auth_user(user)
+
+    await asyncio.gather(*filter(None, _auth_tasks.values()))
+    _loading = False
+    _auth_tasks.clear()
+
+    count_user = stats.users
+    count_chat = stats.chats
     await admin_log("Бот запущен.\n" f"🔸 Пользователи: {count_user}\n" f"🔸 Беседы: {count_chat}")
     logger.info(f"Auth of {count_user} users and {count_chat} chats complete")
+
+
+class RestoreMessageMiddleware(BaseMiddleware[Message]):
+    async def pre(self):
+        if _loading:  # startup authorization is not finished
+            for peer_id in {self.event.peer_id, self.event.from_id}:
+                await restore(peer_id)
+            self.event.state_peer = await bp.state_dispenser.get(self.event.peer_id)
+
+
+class RestoreEventMiddleware(BaseMiddleware[dict]):
+    async def pre(self):
+        if _loading:  # startup authorization is not finished
+            event_object: dict = self.event.get("object", {})
+            for peer_id in {event_object.get("peer_id"), event_object.get("user_id")}:
+                if peer_id:
+                    await restore(peer_id)
+
+
+def _account_id(state_peer: Optional[StatePeer]) -> Optional[int]:
+    """vk_id of user, whose diary account is used by the peer"""
+    if state_peer is None or state_peer.state != get_state_repr(MeowState.AUTH):
+        return None
+    return state_peer.payload.get("user_id", state_peer.peer_id)
+
+
+class FloodMessageMiddleware(BaseMiddleware[Message]):
+    async def pre(self):
+        is_chat = self.event.peer_id != self.event.from_id
+        if is_chat and not self.event.text.startswith(tuple(DEFAULT_PREFIXES)):
+            return  # it isn't a command
+        wait = flood_control.take(self.event.peer_id, _account_id(self.event.state_peer))
+        if wait:
+            if flood_control.warn(self.event.peer_id):
+                await self.event.answer(flood_info(wait))
+            self.stop(f"Flood control of {self.event.peer_id}")
+
+
+async def _is_cached(event: MessageEvent, state_peer: Optional[StatePeer]) -> bool:
+    """Callback is answered from cache (without request to the diary server)"""
+    payload = event.payload
+    if _account_id(state_peer) is None or not isinstance(payload, dict):
+        return False
+    try:
+        api = await get_api(state_peer)  # type: ignore
+        child: int = state_peer.payload["child_id"]  # type: ignore
+        if payload.get("keyboard") == "diary":
+            shown = "lesson" in payload or bool(payload.get("hide"))
+            return diary_cache.has_diary(
+                api,
+                event.peer_id,
+                event.conversation_message_id,
+                payload.get("date"),
+                child,
+                shown,
+            )
+        if payload.get("keyboard") == "marks":
+            kind = "lessons_scores" if payload.get("count") else "progress_average"
+            return diary_cache.has_scores(api, kind, payload.get("date"), child)
+    except (KeyError, IndexError):  # user is deleted or child is not found after re-auth
+        pass
+    return False
+
+
+class FloodEventMiddleware(BaseMiddleware[dict]):
+    async def pre(self):
+        if self.event.get("type") != GroupEventType.MESSAGE_EVENT:
+            return
+        event = MessageEvent(**self.event)
+        event.unprepared_ctx_api = bp.api
+        state_peer = await bp.state_dispenser.get(event.peer_id)
+        wait = flood_control.take(event.peer_id, _account_id(state_peer))
+        if wait and not await _is_cached(event, state_peer):
+            await event.show_snackbar(flood_info(wait))
+            self.stop(f"Flood control of {event.peer_id}")
+
+
+bp.labeler.message_view.register_middleware(RestoreMessageMiddleware)
+bp.labeler.raw_event_view.register_middleware(RestoreEventMiddleware)
+bp.labeler.message_view.register_middleware(FloodMessageMiddleware)
+bp.labeler.raw_event_view.register_middleware(FloodEventMiddleware)
@@ -1,20 +1,22 @@
 """
 Private integration (all private message handler)
 """
-import json
 from typing import Optional, Tuple
 
-from barsdiary.aio import APIError, DiaryApi
+from barsdiary.aio import APIError
+from barsdiary.types import DiaryObject, ProgressAverageObject
 from loguru import logger
 from vkbottle.bot import Blueprint, BotLabeler, Message, rules
 from vkbottle.dispatch.dispenser import get_state_repr
 from vkbottle_types.objects import MessagesTemplateActionTypeNames
 
-from vk_bot import keyboard
+from vk_bot import diary_cache, keyboard
 from vk_bot.db import Child, User
-from vk_bot.diary_infromation import diary_info, progress_average_info
+from vk_bot.diary_infromation import diary_info, freshness_info, progress_average_info
 from vk_bot.error_handler import diary_date_error_handler, message_error_handler
+from vk_bot.sessions import auth_by_login, get_api, sessions
 
+from . import scheduler
 from .other import MeowState, admin_log, tomorrow
 
 labeler = BotLabeler(auto_rules=[rules.PeerRule(False)])
@@ -39,20 +41,19 @@ async def password_handler(message: Message):
     login = message.state_peer.payload.get("login")
     password = message.text
     try:
-        api = await DiaryApi.auth_by_login(
-            "sosh.mon-ra.ru", login, password  # TODO add region select
-        )
+        api = await auth_by_login(login, password)
         await User.create(
             message.peer_id,
             diary_session=api.sessionid,
-            diary_information=json.dumps(api.user_information),
+            diary_information=api.user_information,
             children=[
                 Child(vk_id=message.peer_id, child_id=child_id)
                 for child_id in range(len(api.user.children))
             ],
             chats=[],
         )
-        await bp.state_dispenser.set(message.peer_id, MeowState.AUTH, api=api, child_id=0)
+        await sessions.put(message.peer_id, api)
+        await bp.state_dispenser.set(message.peer_id, MeowState.AUTH, child_id=0)
 
         await admin_log(f"Авторизован новый пользователь: @id{message.peer_id}")
         logger.info(f"Auth new user: id{message.peer_id}")
@@ -108,29 +109,45 @@ async def re_auth_password_handler(message: Message):
     login = message.state_peer.payload.get("login")
     password = message.text
     try:
-        api = await DiaryApi.auth_by_login(
-            "sosh.mon-ra.ru", login, password
-        )  # TODO add region select
+        api = await auth_by_login(login, password)
         user = await User.get(message.peer_id)
+        subscribed = [child for child in user.children if child.marks_notify]
+        for child in subscribed:  # subscriptions are grouped by diary, it can be another now
+            await scheduler.delete(child)
         user.diary_session = api.sessionid
-        user.diary_information = json.dumps(api.user_information)
-        await Child.update_count(message.peer_id, len(api.user.children))
+        user.diary_information = api.user_information
         await user.save()
+        await Child.update_count(message.peer_id, len(api.user.children))
+        await sessions.put(message.peer_id, api)
+
+        notify_off = False
+        for child in subscribed:
+            if child.child_id >= len(api.user.children):  # it's deleted
+                continue
+            try:
+                await scheduler.add(child, api)
+            except Exception as e:  # user can subscribe again in settings
+                logger.warning(f"Re-subscribe of {child} is failed: {e!r}")
+                child.marks_notify = False
+                await child.save()
+                notify_off = True
 
         for chat in user.chats:
             await bp.state_dispenser.set(
-                chat.peer_id, MeowState.AUTH, api=api, user_id=user.vk_id, child_id=0
+                chat.peer_id, MeowState.AUTH, user_id=user.vk_id, child_id=0
             )
             logger.debug(f"Auth chat{chat.peer_id - 2_000_000_000} complete")
 
-        await bp.state_dispenser.set(message.peer_id, MeowState.AUTH, api=api, child_id=0)
+        await bp.state_dispenser.set(message.peer_id, MeowState.AUTH, child_id=0)
 
         logger.info(f"Re-auth complete: id{message.peer_id}")
-        await message.answer(
-            message="🔓 Вы успешно авторизовались!\n"
-            "Воспользуйтесь кнопками снизу или напишите /помощь (/help) для команд",
-            keyboard=keyboard.MENU,
+        text = (
+            "🔓 Вы успешно авторизовались!\n"
+            "Воспользуйтесь кнопками снизу или напишите /помощь (/help) для команд"
         )
+        if notify_off:
+            text += "\n\n🔕 Уведомления об оценках выключены, включите их в настройках"
+        await message.answer(message=text, keyboard=keyboard.MENU)
     except APIError as e:
         if not e.json_success:
             await bp.state_dispenser.set(message.peer_id, MeowState.RE_LOGIN)
@@ -251,13 +268,28 @@ async def menu_command(message: Message):
 @diary_date_error_handler.catch
 async def diary_command(message: Message, args: Tuple[str]):
     date = args[0]  # TODO add check
-    api: DiaryApi = message.state_peer.payload["api"]
+    api = await get_api(message.state_peer)
     child_id: int = message.state_peer.payload["child_id"]
-    diary = await api.diary(date, child=child_id)
-    await message.answer(
-        message=diary_info(diary), keyboard=keyboard.diary_week(date), dont_parse_links=True
+    served = await diary_cache.serve_diary(api, date, child_id)
+    response = await message.answer(
+        message=diary_info(served.data) + freshness_info(served.age),
+        keyboard=keyboard.diary_week(date),
+        dont_parse_links=True,
     )
 
+    async def edit(diary: DiaryObject):
+        await bp.api.messages.edit(
+            peer_id=response.peer_id,
+            conversation_message_id=response.conversation_message_id,
+            message=diary_info(diary),
+            keyboard=keyboard.diary_week(date),
+            dont_parse_links=True,
+        )
+
+    diary_cache.show_day(response.peer_id, response.conversation_message_id, date, served)
+    diary_cache.on_refresh(served, edit)
+    diary_cache.prefetch(api, date, child_id)
+
 
 @bp.on.message(rules.CommandRule("дневник") | rules.CommandRule("diary"), state=MeowState.AUTH)
 @diary_date_error_handler.catch
@@ -271,15 +303,26 @@ async def diary_empty_command(message: Message):
 @diary_date_error_handler.catch
 async def marks_command(message: Message, args: Tuple[str]):
     date = args[0]  # todo check
-    api: DiaryApi = message.state_peer.payload["api"]
+    api = await get_api(message.state_peer)
     child_id: int = message.state_peer.payload["child_id"]
-    marks = await api.progress_average(date, child=child_id)
-    await message.answer(
-        message=progress_average_info(marks),
+    served = await diary_cache.last_scores(api, "progress_average", date, child_id)
+    response = await message.answer(
+        message=progress_average_info(served.data) + freshness_info(served.age),
         keyboard=keyboard.marks_stats(date),
         dont_parse_links=True,
     )
 
+    async def edit(progress_average: ProgressAverageObject):
+        await bp.api.messages.edit(
+            peer_id=response.peer_id,
+            conversation_message_id=response.conversation_message_id,
+            message=progress_average_info(progress_average),
+            keyboard=keyboard.marks_stats(date),
+            dont_parse_links=True,
+        )
+
+    diary_cache.on_refresh(served, edit)
+
 
 @bp.on.message(rules.CommandRule("оценки") | rules.CommandRule("marks"), state=MeowState.AUTH)
 @diary_date_error_handler.catch
@@ -1,66 +1,290 @@
 """
 Schedulers module (marks notification)
 """
+import asyncio
 import datetime
-from typing import Dict, List, Optional, Tuple
-
+import hashlib
+import heapq
+import itertools
+import json
+import time
+import zlib
+from sys import intern
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+
+from aiohttp import ClientError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from barsdiary.aio import DiaryApi
+from barsdiary.aio import APIError, DiaryApi
+from barsdiary.types import LessonsScoreObject, LoginObject
 from vkbottle.bot import Blueprint
+from vkbottle.dispatch.dispenser import get_state_repr
 from vkbottle.modules import logger
 
-from vk_bot.blueprints.other import admin_log
-from vk_bot.db import Child, User, select, session
+from vk_bot import diary_cache
+from vk_bot.blueprints.other import MeowState, admin_log, restore
+from vk_bot.circuit_breaker import CLOSED, OPEN, CircuitBreaker
+from vk_bot.db import Child, ChildMarks
 from vk_bot.error_handler import scheduler_error_handler
+from vk_bot.notifications import NotificationQueue
+from vk_bot.sessions import sessions
 
 
-class Marks:
-    def __init__(self, lesson: str, date: str, text: str, mark: str):
-        self.lesson = lesson
-        self.date = date
-        self.text = text
-        self.mark = mark
+class Marks(NamedTuple):  # tuple with interned strings, it's compact for thousands of children
+    lesson: str
+    date: str
+    text: str
+    mark: str
 
     @classmethod
-    async def from_api(cls, child: Child) -> Tuple[Dict["Marks", int], Optional[str]]:
-        state_peer = await bp.state_dispenser.get(child.vk_id)
-        if not state_peer:
-            return {}, None
-        api: DiaryApi = state_peer.payload["api"]
-        if api.closed:
-            return DATA[child]  # wait for re-auth
-
-        lessons_score = await api.lessons_scores(_today(), child=child.child_id)
+    def from_scores(cls, lessons_score: LessonsScoreObject) -> Dict["Marks", int]:
         ans: Dict[Marks, int] = {}
-        for lesson, data in lessons_score.data.items():
+        for lesson, data in (lessons_score.data or {}).items():
+            lesson = intern(lesson)
             for score in data:
+                date = intern(score.date)
                 for text, marks_list in score.marks.items():
-                    for mark_int in marks_list:
-                        marks = cls(lesson, score.date, text, mark_int)
-                        ans.setdefault(marks, 0)
-                        ans[marks] += 1
-        return ans, lessons_score.sub_period
-
-    def __hash__(self):
-        return hash((self.lesson, self.date, self.text, self.mark))
-
-    def __eq__(self, other):
-        if isinstance(other, Marks):
-            return (
-                self.lesson == other.lesson
-                and self.date == other.date
-                and self.text == other.text
-                and self.mark == other.mark
-            )
+                    text = intern(text)
+                    for mark_str in marks_list:
+                        marks = cls(lesson, date, text, intern(mark_str))
+                        ans[marks] = ans.get(marks, 0) + 1
+        return ans
+
+
+DiaryKey = Tuple[int, int]  # (diary user id, pupil id), same for vk users with one diary login
+
+
+def _diary_key(child: Child, user: LoginObject) -> DiaryKey:
+    return user.id, user.children[child.child_id].id
+
+
+class Snapshot(NamedTuple):
+    marks: Dict[Marks, int]
+    sub_period: Optional[str]
+    digest: Optional[str]  # digest of lessons_scores response (not stored in db)
+
+
+def _digest(lessons_score: LessonsScoreObject) -> str:
+    data = lessons_score.json(sort_keys=True, ensure_ascii=False).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+async def _api(child: Child) -> Optional[DiaryApi]:
+    await restore(child.vk_id)  # if startup authorization is not finished
+    state_peer = await bp.state_dispenser.get(child.vk_id)
+    if not state_peer or state_peer.state != get_state_repr(MeowState.AUTH):
+        return None  # wait for re-auth
+    return await sessions.get(child.vk_id)
+
+
+def _is_key_of(child: Child, api: DiaryApi, key: DiaryKey) -> bool:
+    """api is still logged in the diary of key (user can re-login with another login)"""
+    try:
+        return _diary_key(child, api.user) == key
+    except (IndexError, TypeError):  # pupil is not found
         return False
 
 
-childs_marks = select(Child).join(User).where(Child.marks_notify.is_(True))
+async def _representative(key: DiaryKey) -> Optional[Child]:  # subscriber with working api
+    for child in _subscribers.get(key, []):
+        api = await _api(child)
+        if api is not None and _is_key_of(child, api, key):
+            return child
+    return None
+
+
+async def _lessons_scores(child: Child) -> Optional[LessonsScoreObject]:
+    api = await _api(child)
+    if api is None:
+        return None
+    return await asyncio.wait_for(
+        diary_cache.lessons_scores(api, _today(), child.child_id), CHILD_TIMEOUT
+    )
+
+
+async def _snapshot(key: DiaryKey) -> Snapshot:
+    child = await _representative(key)
+    lessons_score = None if child is None else await _lessons_scores(child)
+    if lessons_score is None:
+        return Snapshot({}, None, None)
+    return Snapshot(
+        Marks.from_scores(lessons_score), lessons_score.sub_period, _digest(lessons_score)
+    )
+
+
+def _is_server_error(e: BaseException) -> bool:
+    if isinstance(e, APIError):
+        return e.resp.status >= 500
+    return isinstance(e, (asyncio.TimeoutError, ClientError))
+
+
+async def _breaker_change(state: str):
+    if state == CLOSED:
+        await admin_log("Сервер дневника снова работает. Уведомления возобновлены.")
+    else:
+        await admin_log(
+            f"Сервер дневника не отвечает ({BREAKER_THRESHOLD} ошибок подряд). "
+            "Уведомления приостановлены."
+        )
+
 
 scheduler = AsyncIOScheduler()
 bp = Blueprint(name="Scheduler")  # use for message_send
 
-DATA: Dict[Child, Tuple[Dict[Marks, int], Optional[str]]] = {}
+DATA: Dict[DiaryKey, Snapshot] = {}
+
+CONCURRENCY = 16  # diary requests at the same time
+CHILD_TIMEOUT = 30  # seconds for one lessons_scores request
+TICK = 10  # seconds between checks of the queue
+TICK_DEADLINE = 60  # seconds for checks of one tick
+BREAKER_THRESHOLD = 10  # consecutive server errors to stop requests
+BREAKER_TIMEOUT = 60  # seconds before the next probe request
+
+TIMEZONE = ZoneInfo("Europe/Moscow")
+MIN_INTERVAL = 5 * 60  # seconds, after changed marks
+SCHOOL_MAX_INTERVAL = 20 * 60  # seconds, backoff limit in school hours
+MAX_INTERVAL = 2 * 60 * 60  # seconds, backoff limit out of school hours
+SCHOOL_DAYS = range(0, 6)  # monday - saturday
+SCHOOL_HOURS = range(8, 20)
+QUIET_HOURS = range(0, 7)  # no requests at night
+HOLIDAYS: List[Tuple[datetime.date, datetime.date]] = []  # (first, last) days, no requests
+
+_subscribers: Dict[DiaryKey, List[Child]] = {}  # one request, notification for everyone
+_keys: Dict[Tuple[int, int], DiaryKey] = {}  # (vk_id, child_id): key
+_queue: List[Tuple[float, int, DiaryKey]] = []  # heap of (time of next check, order, key)
+_order = itertools.count()
+_next_check: Dict[DiaryKey, float] = {}  # actual time in _queue, other entries are outdated
+_intervals: Dict[DiaryKey, int] = {}  # current backoff of every key
+_changed: Set[DiaryKey] = set()  # keys, which DATA should be stored in db
+_semaphore: Optional[asyncio.Semaphore] = None  # shared by overlapping ticks, created in loop
+notifications = NotificationQueue()  # sent at the end of every tick
+
+diary_breaker = CircuitBreaker(
+    BREAKER_THRESHOLD, BREAKER_TIMEOUT, _is_server_error, _breaker_change
+)
+
+
+def _is_school_time(when: datetime.datetime) -> bool:
+    return when.weekday() in SCHOOL_DAYS and when.hour in SCHOOL_HOURS
+
+
+def _quiet_end(when: datetime.datetime) -> Optional[datetime.datetime]:
+    for first, last in HOLIDAYS:
+        if first <= when.date() <= last:
+            return datetime.datetime.combine(
+                last + datetime.timedelta(days=1), datetime.time(QUIET_HOURS.stop), TIMEZONE
+            )
+    if when.hour in QUIET_HOURS:
+        return datetime.datetime.combine(when.date(), datetime.time(QUIET_HOURS.stop), TIMEZONE)
+    return None
+
+
+def _school_start(when: datetime.datetime) -> datetime.datetime:  # when or next school time
+    if _is_school_time(when):
+        return when
+    day = when.date()
+    if when.hour >= SCHOOL_HOURS.start:
+        day += datetime.timedelta(days=1)
+    while day.weekday() not in SCHOOL_DAYS:
+        day += datetime.timedelta(days=1)
+    return datetime.datetime.combine(day, datetime.time(SCHOOL_HOURS.start), TIMEZONE)
+
+
+def _next_time(now: float, interval: int) -> float:
+    start = datetime.datetime.fromtimestamp(now, TIMEZONE)
+    # backoff is limited in school hours, even if they begin during the interval
+    school_limit = max(
+        _school_start(start), start + datetime.timedelta(seconds=SCHOOL_MAX_INTERVAL)
+    )
+    when = min(start + datetime.timedelta(seconds=interval), school_limit)
+
+    quiet_end = _quiet_end(when)
+    while quiet_end is not None:
+        when = quiet_end
+        quiet_end = _quiet_end(when)
+    return when.timestamp()
+
+
+def _offset(key: DiaryKey) -> int:  # stable for every key, spreads requests over interval
+    return zlib.crc32(f"{key[0]}:{key[1]}".encode()) % MIN_INTERVAL
+
+
+def _aligned(key: DiaryKey, when: float) -> float:  # first time of key's offset after when
+    return when + (_offset(key) - when) % MIN_INTERVAL
+
+
+def _push(key: DiaryKey, when: float):
+    _next_check[key] = when
+    heapq.heappush(_queue, (when, next(_order), key))
+
+
+def _pop_due(now: float) -> List[DiaryKey]:
+    keys = []
+    while _queue and _queue[0][0] <= now:
+        when, _, key = heapq.heappop(_queue)
+        if key in DATA and _next_check.get(key) == when:
+            keys.append(key)
+    return keys
+
+
+def _reschedule(key: DiaryKey, changed: bool):
+    if changed:
+        interval = MIN_INTERVAL
+    else:  # exponential backoff
+        interval = min(_intervals.get(key, MIN_INTERVAL) * 2, MAX_INTERVAL)
+    _intervals[key] = interval
+    _push(key, _aligned(key, _next_time(time.time(), interval)))
+
+
+def _subscribe(child: Child, key: DiaryKey):
+    _keys[child.vk_id, child.child_id] = key
+    _subscribers.setdefault(key, []).append(child)
+
+
+def _unsubscribe(child: Child):
+    key = _keys.pop((child.vk_id, child.child_id), None)
+    if key is not None:
+        _subscribers[key] = [
+            subscriber
+            for subscriber in _subscribers[key]
+            if (subscriber.vk_id, subscriber.child_id) != (child.vk_id, child.child_id)
+        ]
+        if not _subscribers[key]:  # nobody is subscribed
+            del _subscribers[key]
+            DATA.pop(key, None)
+            _next_check.pop(key, None)
+            _intervals.pop(key, None)
+
+
+def _dumps(key: DiaryKey) -> List[dict]:  # same marks for every subscriber
+    marks, sub_period, _ = DATA[key]
+    marks_json = json.dumps(
+        [[mark.lesson, mark.date, mark.text, mark.mark, count] for mark, count in marks.items()],
+        ensure_ascii=False,
+    )
+    return [
+        {
+            "vk_id": child.vk_id,
+            "child_id": child.child_id,
+            "sub_period": sub_period,
+            "marks": marks_json,
+        }
+        for child in _subscribers[key]
+    ]
+
+
+def _loads(child_marks: ChildMarks) -> Snapshot:
+    marks = {
+        Marks(intern(lesson), intern(date), intern(text), intern(mark)): count
+        for lesson, date, text, mark, count in json.loads(child_marks.marks)
+    }
+    return Snapshot(marks, child_marks.sub_period, None)
+
+
+async def _store_changed():
+    rows = [row for key in _changed if key in DATA for row in _dumps(key)]
+    _changed.clear()
+    await ChildMarks.store(rows)
 
 
 def _today() -> str:
@@ -68,16 +292,26 @@ def _today() -> str:
 
 
 @scheduler_error_handler.catch
-async def marks_job(child: Child):
-    old_marks, old_period = DATA[child]
-    new_marks, new_period = await Marks.from_api(child)
+async def marks_job(child: Child):  # child is one of subscribers, its api is used
+    key = _keys[child.vk_id, child.child_id]
+    old_marks, old_period, old_digest = DATA[key]
+    async with diary_breaker:  # only checks, settings and startup don't wait for probe
+        lessons_score = await _lessons_scores(child)
+    if lessons_score is None:
+        return
+
+    digest = _digest(lessons_score)
+    if digest == old_digest:  # nothing changed
+        return
+
+    new_marks, new_period = Marks.from_scores(lessons_score), lessons_score.sub_period
+
+    peer_ids = [subscriber.vk_id for subscriber in _subscribers[key]]
 
     if old_period != new_period:  # new period
-        await bp.api.messages.send(
-            child.vk_id, message=f"🔔 Изменение периода в оценках: {new_period}.\n", random_id=0
-        )
+        notifications.put(peer_ids, f"🔔 Изменение периода в оценках: {new_period}.\n")
         old_marks = new_marks
-        DATA[child] = ({}, new_period)
+        _changed.add(key)
 
     changed_marks: Dict[str, Dict[str, List[str]]] = {}  # date: {lesson: [information]}
 
@@ -100,8 +334,8 @@ async def marks_job(child: Child):
                 changed_marks[mark.date][mark.lesson].append(f"❌ {mark.mark}⃣ {mark.text}")
 
     if changed_marks:
-        if await child.child_count():
-            api: DiaryApi = (await bp.state_dispenser.get(child.vk_id)).payload["api"]
+        api = await sessions.get(child.vk_id)
+        if api.user.children:  # without db request
             name = api.user.children[child.child_id].name
             message = f"🔔 Изменения в оценках\n🧒{name}\n\n"
         else:
@@ -113,38 +347,119 @@ async def marks_job(child: Child):
                 for text in information:
                     message += text + "\n"
             message += "\n"
-        await bp.api.messages.send(child.vk_id, message=message, random_id=0)
-        DATA[child] = new_marks, new_period
+        notifications.put(peer_ids, message)
+        _changed.add(key)
 
+    DATA[key] = Snapshot(new_marks, new_period, digest)
 
-# every 5 minute
-@scheduler.scheduled_job("cron", id="marks_job", minute="*/5", timezone="europe/moscow")
+
+# every child is checked only when its time has come
+@scheduler.scheduled_job(
+    "interval", id="marks_job", seconds=TICK, max_instances=TICK_DEADLINE // TICK
+)
 async def default_scheduler():
-    logger.debug("Check new marks")
-    for child in (await session.execute(childs_marks)).scalars():
-        await marks_job(child)
+    now = time.time()
+    keys = _pop_due(now)
+    if keys:
+        await _check(keys, now)
+    if notifications:
+        await notifications.flush(bp.api)
+
+
+async def _check(keys: List[DiaryKey], now: float):
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(CONCURRENCY)
+    semaphore = _semaphore
+    logger.debug(f"Check new marks of {len(keys)} children")
+
+    async def limited_job(key_: DiaryKey):
+        changed = False
+        try:
+            async with semaphore:
+                if key_ not in DATA:  # unsubscribed while waiting
+                    return
+                old_digest = DATA[key_].digest
+                child = await _representative(key_)
+                if child is not None and diary_breaker.state != OPEN:
+                    await marks_job(child)
+                changed = key_ in DATA and DATA[key_].digest != old_digest
+        except asyncio.CancelledError:
+            raise  # tick deadline, key is carried over to the next tick
+        except Exception as e:  # key is never lost, it's checked again with backoff
+            logger.exception(f"Check of {key_} is failed: {e!r}")
+
+        if key_ not in DATA:  # unsubscribed while checking
+            return
+        if diary_breaker.state == CLOSED:
+            _reschedule(key_, changed)
+        else:  # server is not working, keep interval and check after probe
+            _push(key_, _aligned(key_, time.time() + BREAKER_TIMEOUT))
+
+    tasks = {asyncio.create_task(limited_job(key)): key for key in keys}
+    _, pending = await asyncio.wait(tasks, timeout=TICK_DEADLINE)
+
+    for task in pending:
+        task.cancel()
+        _push(tasks[task], now)  # first in the next tick
+    if pending:
+        logger.info(f"Tick deadline: {len(pending)} children carried over to the next tick")
+
+    await _store_changed()
 
 
 async def start():
     children_count = 0
 
     child: Child
-    for child in (
-        await session.execute(select(Child).where(Child.marks_notify.is_(True)))
-    ).scalars():
+    child_marks: Optional[ChildMarks]
+    for child, child_marks, diary_information in await ChildMarks.get_subscribed():
+        try:
+            key = _diary_key(child, LoginObject.reformat(diary_information))
+        except (IndexError, TypeError):  # pupil is not found in stored information
+            logger.warning(f"{child} is not subscribed: pupil is not found")
+            continue
         children_count += 1
-        DATA[child] = await Marks.from_api(child)
+        _subscribe(child, key)
+        if child_marks is None:  # subscribed before marks were stored in db
+            _changed.add(key)
+        elif key not in DATA:
+            DATA[key] = _loads(child_marks)
+
+    for key in _changed:
+        if key not in DATA:
+            DATA[key] = await _snapshot(key)
+
+    await ChildMarks.delete_unsubscribed()
+    await _store_changed()
+
+    now = time.time()
+    for key in DATA:
+        _push(key, _aligned(key, now))
 
     await admin_log("Уведомления запущены.\n" f"🔸 Уведомления: {children_count}")
     scheduler.start()
 
 
-async def add(child: Child):
-    DATA.setdefault(child, await Marks.from_api(child))
+async def add(child: Child, api: DiaryApi):
+    if (child.vk_id, child.child_id) in _keys:
+        return
+    key = _diary_key(child, api.user)
+    _subscribe(child, key)
+    if key not in DATA:  # nobody with this diary is subscribed
+        try:
+            DATA[key] = await _snapshot(key)
+        except BaseException:  # not subscribed, it can be added again
+            _unsubscribe(child)
+            raise
+        _intervals[key] = MIN_INTERVAL
+        _push(key, _aligned(key, _next_time(time.time(), MIN_INTERVAL)))
+    await ChildMarks.store(_dumps(key))
 
 
 async def delete(child: Child):
-    DATA.pop(child, None)
+    _unsubscribe(child)
+    await ChildMarks.remove(child.vk_id, child.child_id)
 
 
 def stop():
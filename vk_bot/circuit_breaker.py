@@ -0,0 +1,86 @@
+"""
+Circuit breaker for requests to the diary server
+"""
+import time
+from asyncio import CancelledError
+from typing import Awaitable, Callable, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects requests with CircuitOpenError.
+    After `reset_timeout` seconds one probe request is allowed, its success closes the breaker.
+
+    >>> async with breaker:
+    >>>     await api.lessons_scores(...)
+    """
+
+    def __init__(
+        self,
+        threshold: int,
+        reset_timeout: float,
+        is_failure: Callable[[BaseException], bool],
+        on_change: Optional[Callable[[str], Awaitable]] = None,
+    ):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self.on_change = on_change
+
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe = False  # probe request is running
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if self._probe or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self._probe or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self._probe = True
+        return True
+
+    async def _set_state(self, opened: bool):
+        self.opened_at = time.monotonic() if opened else None
+        self._probe = False
+        if self.on_change:
+            await self.on_change(self.state)
+
+    async def __aenter__(self):
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit is {self.state}")
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if isinstance(exc_val, CancelledError):
+            self._probe = False  # probe was not finished, allow another one
+        elif exc_val is not None and self.is_failure(exc_val):
+            self.failures += 1
+            if self._probe:  # server is still not working
+                self.opened_at = time.monotonic()
+                self._probe = False
+            elif self.opened_at is None and self.failures >= self.threshold:
+                await self._set_state(True)
+        else:  # server is working
+            self.failures = 0
+            if self.opened_at is not None:
+                await self._set_state(False)
+        return False
+
+    def __repr__(self):
+        return f"CircuitBreaker(state={self.state!r}, failures={self.failures!r})"
@@ -2,15 +2,149 @@
 Database module (sqlalchemy with aiosqlite)
 """
 import asyncio
-from typing import List, Optional
+import json
+import zlib
+from collections import OrderedDict
+from typing import AsyncIterator, Generic, Hashable, List, Optional, Set, Tuple, TypeVar
+
+from loguru import logger
+from sqlalchemy import (
+    Boolean,
+    Column,
+    ForeignKey,
+    ForeignKeyConstraint,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    TypeDecorator,
+    and_,
+    bindparam,
+    delete,
+    event,
+    exists,
+    func,
+    select,
+    type_coerce,
+)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_scoped_session,
+    create_async_engine,
+)
+from sqlalchemy.orm import Mapped, declarative_base, deferred, relationship, sessionmaker
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+DB_URL = "sqlite+aiosqlite:///db.sqlite3"
+POOL_SIZE = 5  # connections are kept open (aiosqlite opens a new one for every session by default)
+POOL_OVERFLOW = 10
+PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block writer, commit doesn't rewrite rollback journal
+    "synchronous": "NORMAL",  # fsync on checkpoint only (safe with WAL)
+    "mmap_size": 64 * 1024 * 1024,  # bytes
+}
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def make_engine(url: str = DB_URL, tuned: bool = True) -> AsyncEngine:
+    if not tuned:  # sqlalchemy and sqlite defaults
+        return create_async_engine(url, future=True)
+    new_engine = create_async_engine(
+        url,
+        future=True,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_OVERFLOW,
+    )
+    event.listen(new_engine.sync_engine, "connect", _set_pragmas)
+    return new_engine
+
+
+CACHE_SIZE = 1000  # users (and chats), least recently used are evicted
+BATCH_SIZE = 500  # rows in one query of User.iter_all()
+
+T = TypeVar("T")
+
+
+class _Cache(Generic[T]):
+    """LRU cache of loaded objects (they are detached after task is done)"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._objects: "OrderedDict[Hashable, T]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[T]:
+        obj = self._objects.get(key)
+        if obj is not None:
+            self._objects.move_to_end(key)
+        return obj
+
+    def put(self, key: Hashable, obj: T):
+        self._objects[key] = obj
+        self._objects.move_to_end(key)
+        while len(self._objects) > self.size:
+            self._objects.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._objects.pop(key, None)
+
+
+class CompactJSON(TypeDecorator):
+    """JSON compressed by zlib"""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode())
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return json.loads(zlib.decompress(value))
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, func, select
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import Mapped, declarative_base, relationship
 
 Base = declarative_base()
-engine = create_async_engine("sqlite+aiosqlite:///db.sqlite3", future=True)
-session = AsyncSession(engine, expire_on_commit=False)
+engine = make_engine()
+session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+_scoped_tasks: Set["asyncio.Task"] = set()
+
+
+def _remove_session(task: "asyncio.Task"):
+    _scoped_tasks.discard(task)
+    task_session: Optional[AsyncSession] = session.registry.registry.pop(task, None)
+    if task_session is not None:
+        asyncio.get_event_loop().create_task(task_session.close())
+
+
+def _current_task() -> Optional["asyncio.Task"]:
+    task = asyncio.current_task()
+    if task is not None and task not in _scoped_tasks:  # session is closed with the task
+        _scoped_tasks.add(task)
+        task.add_done_callback(_remove_session)
+    return task
+
+
+# every task (update from vk, scheduler job) has own session, so transactions don't interleave
+session = async_scoped_session(session_factory, scopefunc=_current_task)
+
+
+async def _end_read():
+    """Ends read-only transaction, so connection is returned to the pool before task is done"""
+    if not (session.new or session.dirty or session.deleted):
+        await session.commit()
 
 
 class User(Base):
@@ -18,7 +152,8 @@ class User(Base):
 
     vk_id = Column(Integer, primary_key=True)
     diary_session = Column(String, nullable=False)
-    diary_information = Column(String, nullable=False)
+    # loaded only for DiaryApi (User.get_diary), it isn't needed by other handlers
+    diary_information = deferred(Column(CompactJSON, nullable=False))
 
     children: Mapped["Child"] = relationship("Child", lazy="selectin", cascade="all")
     chats: Mapped["Chat"] = relationship("Chat", lazy="selectin", cascade="all")
@@ -34,27 +169,75 @@ class User(Base):
         )
         session.add(user)
         await session.commit()
+        _users.put(vk_id, user)
+        stats.users += 1
+        stats.chats += len(chats)
+        stats.subscribed += sum(bool(child.marks_notify) for child in children)
         return user
 
     @classmethod
     async def get(cls, vk_id) -> Optional["User"]:
-        return await session.get(cls, vk_id)
+        user = _users.get(vk_id)
+        if user is None:
+            user = await session.get(cls, vk_id)
+            await _end_read()
+            if user is not None:
+                _users.put(vk_id, user)
+        return user
+
+    @classmethod
+    async def get_diary(cls, vk_id) -> Optional[Tuple[str, dict]]:
+        """diary_session and diary_information of user"""
+        row = (await session.execute(_DIARY, {"vk_id": vk_id})).one_or_none()
+        await _end_read()
+        return None if row is None else tuple(row)  # type: ignore
+
+    @classmethod
+    async def iter_all(cls, *columns, batch_size: int = BATCH_SIZE) -> AsyncIterator:
+        """
+        All users (or rows with `columns`, they must include User.vk_id) by batches.
+        Every batch is a short query after last vk_id, so long read transaction isn't held.
+        """
+        stmt = (select(*columns) if columns else select(cls)).order_by(cls.vk_id).limit(batch_size)
+        last_vk_id = None
+        while True:
+            result = await session.execute(
+                stmt if last_vk_id is None else stmt.where(cls.vk_id > last_vk_id)
+            )
+            batch = result.all() if columns else result.scalars().all()
+            await _end_read()
+            for row in batch:
+                yield row
+            if len(batch) < batch_size:
+                break
+            last_vk_id = batch[-1].vk_id
 
     @classmethod
     async def get_all(cls) -> List["User"]:
-        return (await session.execute(select(cls))).scalars().all()
+        users = (await session.execute(select(cls))).scalars().all()
+        await _end_read()
+        return users
 
-    @staticmethod
-    async def save():
+    async def save(self):
+        await session.merge(self)  # cached object can be loaded by other task
         await session.commit()
 
     async def delete(self):
-        await session.delete(self)
+        user = await session.merge(self)
+        await session.delete(user)
         await session.commit()
+        _users.pop(self.vk_id)
+        for chat in self.chats:
+            _chats.pop(chat.peer_id)
+        stats.users -= 1
+        stats.chats -= len(user.chats)
+        stats.subscribed -= sum(child.marks_notify for child in user.children)
 
     @staticmethod
     async def count() -> int:
-        return (await session.execute(select(func.count(User.vk_id)))).scalar_one()
+        count = (await session.execute(_USERS_COUNT)).scalar_one()
+        await _end_read()
+        return count
 
     def __repr__(self):
         return f'User(vk_id={self.vk_id!r}, diary_session="...", diary_information="...")'
@@ -69,49 +252,121 @@ class Child(Base):
     child_id = Column(Integer, primary_key=True, nullable=False)
     marks_notify = Column(Boolean, default=False, nullable=False)
 
+    __table_args__ = (
+        # partial index: only subscribed children, scheduler reads them
+        Index("ix_child_subscribed", vk_id, child_id, sqlite_where=marks_notify.is_(True)),
+    )
+
     @staticmethod
     async def update_count(vk_id: int, child_count: int):
         r: List[Child] = (
-            (await session.execute(select(Child).where(Child.vk_id.is_(vk_id)))).scalars().all()
+            (
+                await session.execute(
+                    select(Child).where(Child.vk_id == vk_id).order_by(Child.child_id)
+                )
+            )
+            .scalars()
+            .all()
         )
-        for i in range(len(r), child_count, -1):
+        unsubscribed = 0
+        for i in range(len(r) - 1, child_count - 1, -1):
+            unsubscribed += r[i].marks_notify
             await session.delete(r[i])
         for i in range(len(r), child_count):
             session.add(Child(vk_id=vk_id, child_id=i))
         await session.commit()
+        _users.pop(vk_id)  # children of cached user are changed
+        stats.subscribed -= unsubscribed
 
-    @staticmethod
-    async def save():
+    async def save(self):
+        child = await session.merge(self)
+        toggled = get_history(child, "marks_notify").has_changes()  # compared with db row
         await session.commit()
+        if toggled:
+            stats.subscribed += 1 if child.marks_notify else -1
 
     @staticmethod
     async def marks_count() -> int:
-        return (
+        count = (await session.execute(_MARKS_COUNT)).scalar_one()
+        await _end_read()
+        return count
+
+    def __repr__(self):
+        return f"Child(vk_id={self.vk_id!r}, child_id={self.child_id!r}, marks_notify=False)"
+
+
+class ChildMarks(Base):
+    __tablename__ = "child_marks"
+
+    vk_id = Column(Integer, primary_key=True, nullable=False)
+    child_id = Column(Integer, primary_key=True, nullable=False)
+    sub_period = Column(String)
+    marks = Column(String, nullable=False)  # json: [[lesson, date, text, mark, count], ...]
+
+    __table_args__ = (
+        ForeignKeyConstraint((vk_id, child_id), (Child.vk_id, Child.child_id)),  # type: ignore
+    )
+
+    @staticmethod
+    async def get_subscribed() -> List[Tuple[Child, Optional["ChildMarks"], str]]:
+        rows = (await session.execute(_SUBSCRIBED)).all()
+        await _end_read()
+        return rows
+
+    @staticmethod
+    async def store(rows: List[dict]):
+        if rows:
+            stmt = insert(ChildMarks)
             await session.execute(
-                select(func.count(Child.vk_id)).where(Child.marks_notify.is_(True))
+                stmt.on_conflict_do_update(
+                    index_elements=[ChildMarks.vk_id, ChildMarks.child_id],
+                    set_={"sub_period": stmt.excluded.sub_period, "marks": stmt.excluded.marks},
+                ),
+                rows,
             )
-        ).scalar_one()
+        await session.commit()
 
-    async def child_count(self) -> int:
-        return (
-            await session.execute(
-                select(func.count(Child.child_id)).where(Child.vk_id == self.vk_id)
+    @staticmethod
+    async def remove(vk_id: int, child_id: int):
+        await session.execute(
+            delete(ChildMarks).where(ChildMarks.vk_id == vk_id, ChildMarks.child_id == child_id)
+        )
+        await session.commit()
+
+    @staticmethod
+    async def delete_unsubscribed():
+        await session.execute(
+            delete(ChildMarks)
+            .where(
+                ~exists().where(
+                    Child.vk_id == ChildMarks.vk_id,
+                    Child.child_id == ChildMarks.child_id,
+                    Child.marks_notify.is_(True),
+                )
             )
-        ).scalar_one()
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
 
     def __repr__(self):
-        return f"Child(vk_id={self.vk_id!r}, child_id={self.child_id!r}, marks_notify=False)"
+        return f'ChildMarks(vk_id={self.vk_id!r}, child_id={self.child_id!r}, marks="...")'
 
 
 class Chat(Base):
     __tablename__ = "chats"
 
     peer_id = Column(Integer, primary_key=True)
-    vk_id = Column(Integer, ForeignKey("users.vk_id"), nullable=False)
+    vk_id = Column(Integer, ForeignKey("users.vk_id"), nullable=False, index=True)
 
     @classmethod
     async def get(cls, peer_id) -> Optional["Chat"]:
-        return await session.get(cls, peer_id)
+        chat = _chats.get(peer_id)
+        if chat is None:
+            chat = await session.get(cls, peer_id)
+            await _end_read()
+            if chat is not None:
+                _chats.put(peer_id, chat)
+        return chat
 
     @classmethod
     async def create(cls, peer_id, vk_id) -> "Chat":
@@ -121,28 +376,109 @@ class Chat(Base):
         )
         session.add(chat)
         await session.commit()
+        _chats.put(peer_id, chat)
+        _users.pop(vk_id)  # chats of cached user are changed
+        stats.chats += 1
         return chat
 
     async def delete(self):
-        await session.delete(self)
+        await session.delete(await session.merge(self))
         await session.commit()
+        _chats.pop(self.peer_id)
+        _users.pop(self.vk_id)
+        stats.chats -= 1
 
     @staticmethod
     async def count() -> int:
-        return (await session.execute(select(func.count(Chat.vk_id)))).scalar_one()
+        count = (await session.execute(_CHATS_COUNT)).scalar_one()
+        await _end_read()
+        return count
 
     def __repr__(self):
         return f"Chat(peer_id={self.peer_id!r}, vk_id=0)"
 
 
+class Stats:
+    """Row counters, they are counted on startup and changed after every commit"""
+
+    def __init__(self):
+        self.users = 0
+        self.chats = 0
+        self.subscribed = 0  # children with marks notification
+
+    async def load(self):
+        self.users = await User.count()
+        self.chats = await Chat.count()
+        self.subscribed = await Child.marks_count()
+
+    def __repr__(self):
+        return f"Stats(users={self.users!r}, chats={self.chats!r}, subscribed={self.subscribed!r})"
+
+
+stats = Stats()
+_users: _Cache[User] = _Cache(CACHE_SIZE)  # vk_id: user
+_chats: _Cache[Chat] = _Cache(CACHE_SIZE)  # peer_id: chat
+
+# hot statements are built once, their compiled form is cached by engine
+_USERS_COUNT = select(func.count(User.vk_id))
+_CHATS_COUNT = select(func.count(Chat.vk_id))
+_MARKS_COUNT = select(func.count(Child.vk_id)).where(Child.marks_notify.is_(True))
+_DIARY = select(User.diary_session, User.diary_information).where(User.vk_id == bindparam("vk_id"))
+_SUBSCRIBED = (
+    select(Child, ChildMarks, User.diary_information)
+    .join(User)
+    .outerjoin(
+        ChildMarks,
+        and_(ChildMarks.vk_id == Child.vk_id, ChildMarks.child_id == Child.child_id),
+    )
+    .where(Child.marks_notify.is_(True))
+)
+
+
+def _migrate(conn):
+    """Changes of existing database (create_all creates only new tables with their indexes)"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+    # diary_information was json text
+    users = User.__table__
+    rows = conn.execute(
+        select(users.c.vk_id, type_coerce(users.c.diary_information, String)).where(
+            func.typeof(users.c.diary_information) == "text"
+        )
+    ).all()
+    if rows:
+        conn.execute(
+            users.update()
+            .where(users.c.vk_id == bindparam("b_vk_id"))
+            .values(diary_information=bindparam("b_information", type_=CompactJSON)),
+            [{"b_vk_id": vk_id, "b_information": json.loads(text)} for vk_id, text in rows],
+        )
+
+
+def _check_query_plans(conn):
+    """Logs warning, if hot query scans the whole table instead of index"""
+    for stmt in (_SUBSCRIBED, _MARKS_COUNT, select(Chat).where(Chat.vk_id == 0)):
+        sql = str(stmt.compile(conn, compile_kwargs={"literal_binds": True}))
+        for *_, detail in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql):
+            if detail.startswith("SCAN") and "INDEX" not in detail:
+                logger.warning(f"Query plan: {detail}\n{sql}")
+
+
 async def start_up():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-    await session.begin()
+        await conn.run_sync(_migrate)
+        await conn.run_sync(_check_query_plans)
+    await stats.load()
 
 
 async def close():
-    await session.close()
+    for task_session in list(session.registry.registry.values()):
+        await task_session.close()
+    session.registry.registry.clear()
+    await engine.dispose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,411 @@
+"""
+Cache of diary responses (one request for the whole week) and coalescing of same requests
+"""
+import asyncio
+import datetime
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from aiohttp import ClientError
+from barsdiary.aio import DiaryApi
+from barsdiary.types import DiaryObject, LessonsScoreObject, ProgressAverageObject
+from loguru import logger
+
+WEEK_TTL = 5 * 60  # seconds, cached week is requested again after it
+MAX_WEEKS = 2000  # least recently used week is evicted over this count
+SHOWN_TTL = 60 * 60  # seconds, lesson buttons of diary message are answered without requests
+MAX_SHOWN = 5000
+SCORES_MAX_AGE = 30 * 60  # seconds, marks statistics is answered from younger stored response
+SCORES_DATE_SPAN = 1  # days, stored response of near date is used (it's the same period usually)
+MAX_SCORES = 5000
+STALE_AFTER = 3  # seconds, stored response is served, if server doesn't answer in time
+REFRESH_DELAY = 30  # seconds, failed request of fresh data is repeated after it
+PREFETCH_CONCURRENCY = 4  # prefetch requests at the same time
+PREFETCH_LIMIT = 100  # pending prefetches, new ones are skipped over this count
+
+WEEK = datetime.timedelta(weeks=1)
+STALE_ERRORS = (asyncio.TimeoutError, ClientError)  # server is slow or not working
+
+WeekKey = Tuple[int, int, int, int]  # diary user id, pupil id, iso year, iso week
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_flights: Dict[Hashable, "asyncio.Task"] = {}  # key of request: task of request
+
+
+def _landed(key: Hashable, task: "asyncio.Task"):
+    if _flights.get(key) is task:
+        del _flights[key]
+    if not task.cancelled():
+        task.exception()  # it's retrieved, even if all waiters are cancelled
+
+
+async def _single_flight(
+    api: DiaryApi, request_key: Hashable, request: Callable[[], Awaitable[T]]
+) -> T:
+    """
+    Concurrent calls with the same key and diary session wait for one request
+    (users with one diary login don't get error of another's expired session)
+    """
+    key = (api.sessionid, request_key)
+    task = _flights.get(key)
+    if task is None:
+        task = asyncio.ensure_future(request())
+        _flights[key] = task
+        task.add_done_callback(lambda done: _landed(key, done))
+    return await asyncio.shield(task)  # cancelled waiter doesn't cancel request of others
+
+
+def _pupil(api: DiaryApi, child: int) -> Tuple[int, int]:
+    return api.user.id, api.user.children[child].id
+
+
+def _date(date_str: str) -> datetime.date:  # 21.12.2012
+    return datetime.date(*map(int, date_str.split(".")[::-1]))
+
+
+def _week_key(api: DiaryApi, child: int, date: datetime.date) -> WeekKey:
+    year, week, _ = date.isocalendar()
+    return (*_pupil(api, child), year, week)
+
+
+class TTLCache(Generic[K, V]):
+    """LRU cache with at most `size` values, value is fresh for `ttl` seconds"""
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self._values: "OrderedDict[K, Tuple[V, float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key: K) -> Optional[V]:
+        value, stored = self._values.get(key, (None, 0.0))
+        if value is None or time.monotonic() - stored > self.ttl:
+            return None
+        self._values.move_to_end(key)
+        return value
+
+    def get_stale(self, key: K) -> Optional[Tuple[V, float]]:
+        """Value (even if it isn't fresh) and its age"""
+        value, stored = self._values.get(key, (None, 0.0))
+        if value is None:
+            return None
+        return value, time.monotonic() - stored
+
+    def discard(self, key: K):
+        self._values.pop(key, None)
+
+    def put(self, key: K, value: V):
+        self._values[key] = value, time.monotonic()
+        self._values.move_to_end(key)
+        while len(self._values) > self.size:
+            self._values.popitem(last=False)
+
+
+class Scores(NamedTuple):
+    data: Union[LessonsScoreObject, ProgressAverageObject]
+    date: str  # date of request
+    fetched: float  # time.time() of response
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched
+
+
+class Served(NamedTuple):
+    data: Any
+    age: float  # seconds, it's 0 for requested response
+    refresh: Optional["asyncio.Task"] = None  # request of fresh data, if stale one is served
+
+
+# diary weeks are shared by users with the same api (private and chats)
+weeks: TTLCache[WeekKey, DiaryObject] = TTLCache(WEEK_TTL, MAX_WEEKS)
+# day, which is shown in message (peer_id, conversation_message_id, date), for its keyboard
+# value is (day, time.monotonic() of response)
+shown_days: TTLCache[Tuple[int, int, str], Tuple[DiaryObject, float]] = TTLCache(
+    SHOWN_TTL, MAX_SHOWN
+)
+# last lessons_scores and progress_average of pupil, scheduler updates subscribed ones
+# (progress_average is dropped, when new lessons_scores has other marks)
+stored_scores: TTLCache[Tuple[str, int, int], Scores] = TTLCache(SCORES_MAX_AGE, MAX_SCORES)
+
+
+async def diary_week(api: DiaryApi, date: datetime.date, child: int) -> DiaryObject:
+    key = _week_key(api, child, date)
+    week = weeks.get(key)
+    if week is None:
+        monday = date - datetime.timedelta(days=date.weekday())
+        from_date = monday.strftime("%d.%m.%Y")
+        to_date = (monday + datetime.timedelta(days=6)).strftime("%d.%m.%Y")
+
+        async def request() -> DiaryObject:  # week is cached, even if all waiters are cancelled
+            new_week = await api.diary(from_date, to_date, child=child)
+            weeks.put(key, new_week)
+            return new_week
+
+        week = await _single_flight(api, ("diary", key), request)
+    return week
+
+
+_prefetches: Dict[WeekKey, "asyncio.Task"] = {}
+_prefetch_semaphore: Optional[asyncio.Semaphore] = None  # created in running loop
+
+
+async def _prefetch_week(api: DiaryApi, date: datetime.date, child: int):
+    global _prefetch_semaphore
+    if _prefetch_semaphore is None:
+        _prefetch_semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+    try:
+        async with _prefetch_semaphore:
+            await diary_week(api, date, child)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:  # it's requested again by user
+        logger.debug(f"Prefetch of {date} is failed: {e!r}")
+
+
+def prefetch(api: DiaryApi, date_str: str, child: int = 0):
+    """Requests previous and next weeks in background, user usually goes to them"""
+    try:
+        date = _date(date_str)
+    except (ValueError, TypeError):
+        return
+    pupil = _pupil(api, child)
+    dates = {_week_key(api, child, d): d for d in (date - WEEK, date + WEEK)}
+
+    for key, task in list(_prefetches.items()):  # user has gone to other week
+        if key[:2] == pupil and key not in dates:
+            task.cancel()
+
+    for key, week_date in dates.items():
+        if key in _prefetches or weeks.get(key) is not None:
+            continue
+        if len(_prefetches) >= PREFETCH_LIMIT:
+            break
+        task = asyncio.create_task(_prefetch_week(api, week_date, child))
+        _prefetches[key] = task
+        task.add_done_callback(lambda done, k=key: _prefetches.pop(k, None))
+
+
+_refreshes: Set["asyncio.Task"] = set()
+
+
+async def _request_later(request: Callable[[], Awaitable[T]]) -> T:
+    await asyncio.sleep(REFRESH_DELAY)
+    return await request()
+
+
+async def _serve(request: Callable[[], Awaitable[T]], stale: Optional[Tuple[T, float]]) -> Served:
+    """
+    Requested response. If server doesn't answer in STALE_AFTER seconds or isn't working,
+    stale response is served and fresh one is requested in background.
+    """
+    if stale is None:
+        return Served(await request(), 0.0)
+    task = asyncio.ensure_future(request())
+    done, _ = await asyncio.wait({task}, timeout=STALE_AFTER)
+    if not done:  # server is slow, response is awaited in background
+        refresh = task
+    elif task.exception() is None:
+        return Served(task.result(), 0.0)
+    elif isinstance(task.exception(), STALE_ERRORS):
+        refresh = asyncio.ensure_future(_request_later(request))
+    else:
+        raise task.exception()  # type: ignore
+    logger.debug(f"Stale response ({stale[1]:.0f} s) is served")
+    return Served(stale[0], stale[1], refresh)
+
+
+def on_refresh(served: Served, edit: Callable[[Any], Awaitable]):
+    """Message with stale response is edited by `edit(fresh_data)` in background"""
+    if served.refresh is None:
+        return
+    refresh_task = served.refresh
+
+    async def refresh():
+        try:
+            await edit(await refresh_task)
+        except asyncio.CancelledError:
+            refresh_task.cancel()
+            raise
+        except Exception as e:  # user will request it again
+            logger.info(f"Stale message isn't refreshed: {e!r}")
+
+    task = asyncio.create_task(refresh())
+    _refreshes.add(task)
+    task.add_done_callback(_refreshes.discard)
+
+
+def cancel_background():
+    """Cancels prefetches and refreshes of stale messages"""
+    for task in [*_prefetches.values(), *_refreshes]:
+        task.cancel()
+
+
+async def diary(api: DiaryApi, date_str: str, child: int = 0) -> DiaryObject:
+    """api.diary(date_str, child=child) from the cached week"""
+    try:
+        date = _date(date_str)
+    except (ValueError, TypeError):  # server answers about wrong date
+        return await _single_flight(
+            api, ("diary", _pupil(api, child), date_str), lambda: api.diary(date_str, child=child)
+        )
+    week = await diary_week(api, date, child)
+    days = [day for day in week.days if day.date == date]
+    if not days:  # server didn't return this day in the week
+        return await _single_flight(
+            api, ("diary", _pupil(api, child), date_str), lambda: api.diary(date_str, child=child)
+        )
+    return week.copy(update={"days": days})
+
+
+def _stale_day(api: DiaryApi, date_str: str, child: int) -> Optional[Tuple[DiaryObject, float]]:
+    try:
+        date = _date(date_str)
+    except (ValueError, TypeError):
+        return None
+    stale = weeks.get_stale(_week_key(api, child, date))
+    if stale is None:
+        return None
+    week, age = stale
+    days = [day for day in week.days if day.date == date]
+    return (week.copy(update={"days": days}), age) if days else None
+
+
+def _week_age(api: DiaryApi, date_str: str, child: int) -> float:
+    try:
+        stale = weeks.get_stale(_week_key(api, child, _date(date_str)))
+    except (ValueError, TypeError):
+        return 0.0
+    return 0.0 if stale is None else stale[1]
+
+
+async def serve_diary(api: DiaryApi, date_str: str, child: int = 0) -> Served:
+    """diary() or stale day, if server is slow or not working"""
+    served = await _serve(lambda: diary(api, date_str, child), _stale_day(api, date_str, child))
+    if served.refresh is None:  # day is taken from the cached week
+        return served._replace(age=_week_age(api, date_str, child))
+    return served
+
+
+def show_day(peer_id: int, message_id: int, date_str: str, served: Served):
+    """Day is kept for lesson buttons of the message with it"""
+    key = (peer_id, message_id, date_str)
+    if served.refresh is None:
+        shown_days.put(key, (served.data, time.monotonic() - served.age))
+    else:  # stale day isn't kept, fresh one will be shown
+
+        def keep(task: "asyncio.Task"):
+            if not task.cancelled() and task.exception() is None:
+                shown_days.put(key, (task.result(), time.monotonic()))
+
+        served.refresh.add_done_callback(keep)
+
+
+async def message_diary(
+    api: DiaryApi, peer_id: int, message_id: int, date_str: str, child: int = 0
+) -> Served:
+    """Day, which is kept for the message by show_day(), or serve_diary()"""
+    shown = shown_days.get((peer_id, message_id, date_str))
+    if shown is not None:
+        day, fetched = shown
+        return Served(day, time.monotonic() - fetched)
+    served = await serve_diary(api, date_str, child)
+    show_day(peer_id, message_id, date_str, served)
+    return served
+
+
+def has_diary(
+    api: DiaryApi,
+    peer_id: int,
+    message_id: int,
+    date_str: str,
+    child: int = 0,
+    shown: bool = False,
+) -> bool:
+    """message_diary() (if `shown`) or serve_diary() is answered from cache (without request)"""
+    if shown and shown_days.get((peer_id, message_id, date_str)) is not None:
+        return True
+    try:
+        date = _date(date_str)
+    except (ValueError, TypeError):
+        return False
+    week = weeks.get(_week_key(api, child, date))
+    return week is not None and any(day.date == date for day in week.days)
+
+
+async def _scores_request(kind: str, api: DiaryApi, date: str, child: int) -> Scores:
+    key = (kind, *_pupil(api, child))
+
+    async def request() -> Scores:
+        data = await getattr(api, kind)(date, child=child)
+        if kind == "lessons_scores":
+            old_scores = stored_scores.get_stale(key)  # type: ignore
+            if old_scores is None or old_scores[0].data != data:  # marks are changed
+                stored_scores.discard(("progress_average", *_pupil(api, child)))
+        scores = Scores(data, date, time.time())
+        stored_scores.put(key, scores)  # type: ignore
+        return scores
+
+    return await _single_flight(api, (key, date), request)
+
+
+def _near(date_str: str, other_date_str: str) -> bool:
+    try:
+        return abs((_date(date_str) - _date(other_date_str)).days) <= SCORES_DATE_SPAN
+    except (ValueError, TypeError):
+        return date_str == other_date_str
+
+
+async def last_scores(api: DiaryApi, kind: str, date: str, child: int = 0) -> Served:
+    """
+    Stored response of `kind` ("lessons_scores" or "progress_average") for near date,
+    it's requested, if there isn't response younger than SCORES_MAX_AGE
+    (stale one is served, if server is slow or not working)
+    """
+    key = (kind, *_pupil(api, child))
+    scores = stored_scores.get(key)  # type: ignore
+    if scores is not None and _near(scores.date, date):
+        return Served(scores.data, scores.age)
+
+    stale = stored_scores.get_stale(key)  # type: ignore
+    stale_data = None
+    if stale is not None and _near(stale[0].date, date):
+        stale_data = stale[0].data, stale[0].age
+
+    async def request():
+        return (await _scores_request(kind, api, date, child)).data
+
+    return await _serve(request, stale_data)
+
+
+def has_scores(api: DiaryApi, kind: str, date: str, child: int = 0) -> bool:
+    """last_scores() is answered from cache (without request)"""
+    scores = stored_scores.get((kind, *_pupil(api, child)))  # type: ignore
+    return scores is not None and _near(scores.date, date)
+
+
+async def progress_average(api: DiaryApi, date: str, child: int = 0) -> ProgressAverageObject:
+    return (await _scores_request("progress_average", api, date, child)).data  # type: ignore
+
+
+async def lessons_scores(api: DiaryApi, date: str, child: int = 0) -> LessonsScoreObject:
+    """Requested response (the scheduler uses it), it's stored for last_scores()"""
+    return (await _scores_request("lessons_scores", api, date, child)).data  # type: ignore
@@ -119,3 +119,9 @@ def lesson_score_info(obj: LessonsScoreObject):
     return f"📅 {obj.sub_period}\n\n" + "\n".join(
         f"{lesson}:\n{_get_score_stat(score)}" for lesson, score in obj.data.items()
     )
+
+
+def freshness_info(age: float) -> str:  # for stored responses
+    if age < 60:
+        return ""
+    return f"\n\n🕒 Обновлено {int(age // 60)} мин. назад"
@@ -1,7 +1,7 @@
 """
 Error handlers (catch all errors in handlers, vkbottle)
 """
-from asyncio import TimeoutError
+from asyncio import CancelledError, TimeoutError
 from typing import Tuple, Union
 
 from aiohttp import ClientError
@@ -12,6 +12,7 @@ from vkbottle import ErrorHandler, VKAPIError
 from vkbottle.bot import Message, MessageEvent
 
 from .blueprints.other import admin_log, re_auth
+from .circuit_breaker import CircuitOpenError
 from .db import Child
 
 message_error_handler = ErrorHandler(redirect_arguments=True)
@@ -194,6 +195,16 @@ async def scheduler_diary(e: APIError, child: Child):
     await admin_log(f"Ошибка в scheduler(1) у @id{child.vk_id}")
 
 
+@scheduler_error_handler.register_error_handler(CancelledError)
+async def scheduler_cancelled(e: CancelledError, _):
+    raise e  # tick deadline, child is carried over to the next tick
+
+
+@scheduler_error_handler.register_error_handler(CircuitOpenError)
+async def scheduler_circuit_open(e: CircuitOpenError, _):
+    logger.debug(f"Skip request: {e}")
+
+
 @scheduler_error_handler.register_error_handler(TimeoutError, ClientError)
 async def scheduler_aiohttp_timeout(e: Union[TimeoutError, ClientError], _):
     logger.info(f"Server error {e}")
@@ -0,0 +1,83 @@
+"""
+Flood control (token buckets of peers and diary accounts)
+"""
+import math
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Set, Tuple
+
+PEER_RATE = 0.5  # requests per second of one peer (user or chat)
+PEER_BURST = 5  # requests in a row
+ACCOUNT_RATE = 1  # requests per second of one diary account (user and his chats)
+ACCOUNT_BURST = 8
+MAX_BUCKETS = 10000  # least recently used bucket is dropped over this count (it's almost full)
+
+
+class TokenBucket:
+    """
+    Every key has `burst` tokens, one token is taken by a request and they are refilled
+    with `rate` tokens per second.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = (
+            OrderedDict()
+        )  # key: (tokens, updated)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _tokens(self, key: Hashable) -> float:
+        tokens, updated = self._buckets.get(key, (self.burst, 0.0))
+        return min(self.burst, tokens + (time.monotonic() - updated) * self.rate)
+
+    def wait_time(self, key: Hashable) -> float:
+        """Seconds before the next request of `key` is allowed"""
+        return max(0.0, (1 - self._tokens(key)) / self.rate)
+
+    def take(self, key: Hashable):
+        self._buckets[key] = self._tokens(key) - 1, time.monotonic()
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > MAX_BUCKETS:
+            self._buckets.popitem(last=False)
+
+
+class FloodControl:
+    """
+    Request is allowed, if both the peer and the diary account (the user, who authorized
+    the peer) have a token. So hot chat can't take requests of the diary server from others.
+    """
+
+    def __init__(self):
+        self.peers = TokenBucket(PEER_RATE, PEER_BURST)
+        self.accounts = TokenBucket(ACCOUNT_RATE, ACCOUNT_BURST)
+        self._warned: Set[int] = set()  # peers, which got message about flood
+
+    def take(self, peer_id: int, account_id: Optional[int]) -> float:
+        """Takes tokens and returns 0 or seconds before the next allowed request"""
+        wait = self.peers.wait_time(peer_id)
+        if account_id is not None:
+            wait = max(wait, self.accounts.wait_time(account_id))
+        if wait:
+            return wait
+        self.peers.take(peer_id)
+        if account_id is not None:
+            self.accounts.take(account_id)
+        self._warned.discard(peer_id)
+        return 0.0
+
+    def warn(self, peer_id: int) -> bool:
+        """Peer should get message about flood (only first time till allowed request)"""
+        if peer_id in self._warned:
+            return False
+        self._warned.add(peer_id)
+        return True
+
+
+def flood_info(wait: float) -> str:
+    return f"🚧 Слишком много запросов. Повторите попытку через {math.ceil(wait)} сек."
+
+
+flood_control = FloodControl()
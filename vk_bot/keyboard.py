@@ -83,7 +83,7 @@ def diary_day(date_str: str, lessons: List[DiaryLessonObject], lesson_id: int =
     if len(lessons[:9]) % 2 == 1:
         keyboard.row()
 
-    keyboard.add(Callback("Скрыть", {"keyboard": "diary", "date": date_str}), white)
+    keyboard.add(Callback("Скрыть", {"keyboard": "diary", "date": date_str, "hide": True}), white)
 
     return keyboard.get_json()
 
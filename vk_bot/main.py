@@ -1,13 +1,14 @@
 import sys
 
-from barsdiary.aio import DiaryApi
 from loguru import logger
 from vkbottle import LoopWrapper
 from vkbottle.bot import Bot
 
+from . import diary_cache
 from .blueprints import admin, chat, message_event, other, private, scheduler
 from .db import close, start_up
 from .error_handler import vkbottle_error_handler
+from .sessions import sessions
 
 if len(sys.argv) < 2:
     raise ValueError("Token is undefined")
@@ -27,17 +28,18 @@ logger.disable("vk_bot.blueprints.scheduler")
 async def _close_session():
     await other.admin_log("Система отключается.")
     scheduler.stop()
+    diary_cache.cancel_background()
     await close()
-    for peer_id, state_peer in bot.state_dispenser.dictionary.items():
-        if peer_id < 2000000000:  # if user
-            api: DiaryApi = state_peer.payload.get("api")
-            if api:  # not None
-                await api.close_session()
+    await sessions.close_all()
 
 
 loop_wrapper = LoopWrapper(
-    on_startup=[start_up(), other.auth_users_and_chats(), scheduler.start()],
+    on_startup=[start_up(), scheduler.start()],
     on_shutdown=[_close_session()],
+    tasks=[
+        other.auth_users_and_chats(),  # bot works while users are authorized
+        sessions.run(),
+    ],
 )
 
 bot = Bot(TOKEN, loop_wrapper=loop_wrapper, error_handler=vkbottle_error_handler)
@@ -0,0 +1,87 @@
+"""
+Notifications queue (messages.send in batches through execute method)
+"""
+import asyncio
+import json
+from typing import List, NamedTuple
+
+from aiohttp import ClientError
+from loguru import logger
+from vkbottle import VKAPIError
+from vkbottle.api import ABCAPI
+
+BATCH_SIZE = 25  # api calls in one execute (vk limit)
+RATE = 3  # execute requests per second
+ATTEMPTS = 3  # notification is dropped after this count of failures
+
+
+class Notification(NamedTuple):
+    peer_ids: List[int]
+    message: str
+    attempt: int = 0
+
+
+def _code(batch: List[Notification]) -> str:
+    # {"sent": ...} instead of bare result: failed call is false, vkbottle can't check bool items
+    calls = ",".join(
+        '{"sent": API.messages.send(%s)}'
+        % json.dumps(
+            {
+                "peer_ids": ",".join(map(str, notification.peer_ids)),
+                "message": notification.message,
+                "random_id": 0,
+            },
+            ensure_ascii=False,
+        )
+        for notification in batch
+    )
+    return f"return [{calls}];"
+
+
+class NotificationQueue:
+    """
+    Notifications are sent on flush() by execute requests with BATCH_SIZE messages.send calls.
+    Failed calls are sent again on the next flush(), requests are limited by RATE.
+    """
+
+    def __init__(self):
+        self._queue: List[Notification] = []
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, peer_ids: List[int], message: str):
+        self._queue.append(Notification(peer_ids, message))
+
+    def _retry(self, notifications: List[Notification]):
+        for notification in notifications:
+            if notification.attempt + 1 < ATTEMPTS:
+                self._queue.append(notification._replace(attempt=notification.attempt + 1))
+            else:
+                logger.warning(f"Notification to {notification.peer_ids} is dropped")
+
+    async def flush(self, api: ABCAPI) -> int:
+        sent = 0
+        async with self._lock:
+            queue, self._queue = self._queue, []
+            for start in range(0, len(queue), BATCH_SIZE):
+                if start:
+                    await asyncio.sleep(1 / RATE)
+                batch = queue[start : start + BATCH_SIZE]
+                try:
+                    response = await api.request("execute", {"code": _code(batch)})
+                except (VKAPIError, ClientError) as e:  # flood control or vk is not working
+                    logger.info(f"Notifications are not sent: {e}")
+                    self._retry(batch)
+                    self._queue.extend(queue[start + BATCH_SIZE :])
+                    break
+
+                failed = [
+                    notification
+                    for notification, result in zip(batch, response["response"])
+                    if not result.get("sent")
+                ]
+                sent += len(batch) - len(failed)
+                self._retry(failed)
+        return sent
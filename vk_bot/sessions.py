@@ -0,0 +1,172 @@
+"""
+DiaryApi sessions of users (created on demand, idle sessions are closed)
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, CookieJar, TCPConnector
+from barsdiary.aio import USER_AGENT, APIError, DiaryApi, _check_response
+from loguru import logger
+from vkbottle.dispatch.dispenser import StatePeer
+
+from .db import User
+
+DIARY_HOST = "sosh.mon-ra.ru"  # TODO add region select
+DIARY_TIMEOUT = 10  # seconds, timeout of request to the diary server
+
+CONNECTIONS_LIMIT = 100  # connections to the diary server, shared by all DiaryApi
+CONNECTIONS_PER_HOST = 30
+KEEPALIVE_TIMEOUT = 30  # seconds, idle connection is kept for next requests
+DNS_CACHE_TTL = 10 * 60  # seconds
+
+MAX_SESSIONS = 1000  # least recently used session is closed over this count
+SESSION_TTL = 30 * 60  # seconds, idle session is closed after it
+EVICT_INTERVAL = 60  # seconds between checks of idle sessions
+CLOSE_DELAY = 60  # seconds, evicted session can be used by running requests till it's closed
+
+
+_connector: Optional[TCPConnector] = None
+
+
+def _client_session(diary_session: Optional[str] = None) -> ClientSession:
+    """ClientSession with shared connection pool and own cookies"""
+    global _connector
+    if _connector is None or _connector.closed:  # created in running loop
+        _connector = TCPConnector(
+            limit=CONNECTIONS_LIMIT,
+            limit_per_host=CONNECTIONS_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            ssl=False,
+        )
+    return ClientSession(
+        connector=_connector,
+        connector_owner=False,
+        cookie_jar=CookieJar(),
+        cookies={"sessionid": diary_session} if diary_session else None,
+        headers={"User-Agent": USER_AGENT},
+        timeout=ClientTimeout(DIARY_TIMEOUT),
+    )
+
+
+def auth_by_diary_session(diary_session: str, diary_information: dict) -> DiaryApi:
+    return DiaryApi(DIARY_HOST, _client_session(diary_session), diary_session, diary_information)
+
+
+async def auth_by_login(login: str, password: str) -> DiaryApi:
+    """DiaryApi.auth_by_login with shared connection pool"""
+    session = _client_session()
+    try:
+        async with session.get(
+            f"https://{DIARY_HOST}/rest/login", params={"login": login, "password": password}
+        ) as r:
+            # private helper of barsdiary 0.1 (as in DiaryApi.auth_by_login), check it on update
+            json = await _check_response(r, session)
+            diary_cookie = r.cookies.get("sessionid")
+            if not diary_cookie:
+                raise ValueError("Authorization failed. No cookie.")
+            return DiaryApi(DIARY_HOST, session, diary_cookie.value, json)
+    except APIError:  # caller closes e.session
+        raise
+    except BaseException:
+        await session.close()
+        raise
+
+
+class DiarySessions:
+    """
+    DiaryApi of every user is created from stored diary_session on first get() and closed
+    after SESSION_TTL seconds without get() or when there are more than MAX_SESSIONS sessions
+    (evicted session is closed after CLOSE_DELAY, so running requests aren't broken).
+    """
+
+    def __init__(self):
+        self._apis: "OrderedDict[int, Tuple[DiaryApi, float]]" = (
+            OrderedDict()
+        )  # vk_id: (api, used)
+        self._locks: Dict[int, asyncio.Lock] = {}  # only for users with session
+        self._evicted: List[Tuple[DiaryApi, float]] = []  # (api, evicted), closed by close_idle
+
+    def __len__(self):
+        return len(self._apis)
+
+    def _open_api(self, vk_id: int) -> Optional[DiaryApi]:
+        api = self._apis.get(vk_id, (None, 0.0))[0]
+        return api if api is not None and not api.closed else None
+
+    @staticmethod
+    async def _create(vk_id: int) -> DiaryApi:
+        diary = await User.get_diary(vk_id)
+        if diary is None:
+            raise KeyError(f"User {vk_id} is not found")
+        return auth_by_diary_session(*diary)
+
+    async def get(self, vk_id: int) -> DiaryApi:
+        api = self._open_api(vk_id)
+        if api is None:
+            async with self._locks.setdefault(vk_id, asyncio.Lock()):  # one session for one user
+                try:
+                    api = self._open_api(vk_id) or await self._create(vk_id)
+                except BaseException:
+                    self._locks.pop(vk_id, None)
+                    raise
+        await self.put(vk_id, api)  # it's the most recently used now
+        return api
+
+    async def put(self, vk_id: int, api: DiaryApi):
+        old_api = self._apis.pop(vk_id, (None, 0.0))[0]
+        if old_api is not None and old_api is not api:
+            await old_api.close_session()
+        self._apis[vk_id] = api, time.monotonic()
+
+        while len(self._apis) > MAX_SESSIONS:
+            lru_vk_id, (lru_api, _) = self._apis.popitem(last=False)
+            self._locks.pop(lru_vk_id, None)
+            self._evicted.append((lru_api, time.monotonic()))
+
+    async def close(self, vk_id: int):
+        api = self._apis.pop(vk_id, (None, 0.0))[0]
+        self._locks.pop(vk_id, None)
+        if api is not None:
+            await api.close_session()
+
+    async def close_idle(self):
+        close_deadline = time.monotonic() - CLOSE_DELAY
+        while self._evicted and self._evicted[0][1] <= close_deadline:
+            await self._evicted.pop(0)[0].close_session()
+
+        deadline = time.monotonic() - SESSION_TTL
+        while self._apis:
+            vk_id, (api, used) = next(iter(self._apis.items()))
+            if used > deadline:  # other sessions are used later
+                break
+            del self._apis[vk_id]
+            self._locks.pop(vk_id, None)
+            await api.close_session()
+
+    async def close_all(self):
+        self._locks.clear()
+        while self._evicted:
+            await self._evicted.pop()[0].close_session()
+        while self._apis:
+            _, (api, _) = self._apis.popitem()
+            await api.close_session()
+        if _connector is not None:
+            await _connector.close()
+
+    async def run(self):
+        """Loop task, closes idle sessions"""
+        while True:
+            await asyncio.sleep(EVICT_INTERVAL)
+            await self.close_idle()
+            logger.debug(f"Diary sessions: {len(self)}")
+
+
+sessions = DiarySessions()
+
+
+async def get_api(state_peer: StatePeer) -> DiaryApi:
+    """DiaryApi of user (or user, who authorized the chat)"""
+    return await sessions.get(state_peer.payload.get("user_id", state_peer.peer_id))